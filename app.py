@@ -8,19 +8,42 @@ import re
 from datetime import datetime
 import shutil
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import time
 import base64
+import io
 import hashlib
 import hmac
 import sys
 import traceback
+import tarfile
+import json
+import bisect
+import heapq
+import threading
+import tempfile
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Налаштування шляхів
 UPLOAD_DIR = "uploads"
 DB_DIR = "dbs"
+BACKUP_DIR = "backups"
+BACKUP_MANIFEST = os.path.join(BACKUP_DIR, "manifest.json")
+BACKUP_KEEP = 3  # скільки незавантажених архівів зберігати на диску
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(DB_DIR, exist_ok=True)
+os.makedirs(BACKUP_DIR, exist_ok=True)
+
+# Налаштування пасажів (MiniLM обрізає вхід до 128 токенів)
+PASSAGE_WORDS = 60
+PASSAGE_OVERLAP = 15
+PASSAGE_POOLING = "max"  # "max" або "mean"
+
+# Версія формату знімка стану пошуку (dbs/snapshot_*)
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SAVE_DELAY = 5  # секунд після останньої зміни до фонового збереження знімка
 
 # Налаштування Tesseract OCR
 try:
@@ -82,6 +105,22 @@ def init_db():
                     timestamp DATETIME,
                     delete_date DATETIME DEFAULT CURRENT_TIMESTAMP)''')
         
+        c.execute('''CREATE TABLE IF NOT EXISTS ocr_cache
+                    (screenshot_path TEXT PRIMARY KEY,
+                    text TEXT)''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS passages
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    record_id INTEGER,
+                    position INTEGER,
+                    text TEXT,
+                    embedding BLOB)''')
+        c.execute("CREATE INDEX IF NOT EXISTS passages_record_id ON passages (record_id)")
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS search_meta
+                    (key TEXT PRIMARY KEY,
+                    value INTEGER)''')
+        
         conn.commit()
         conn.close()
 
@@ -93,6 +132,489 @@ def normalize_text(text):
     text = re.sub(r'\s+', ' ', text).strip().lower()
     return text
 
+# Функція отримання тексту зі скріншота (з кешем у базі)
+def get_ocr_text(conn, screenshot_path):
+    if not screenshot_path:
+        return ""
+    c = conn.cursor()
+    c.execute("SELECT text FROM ocr_cache WHERE screenshot_path = ?", (screenshot_path,))
+    row = c.fetchone()
+    if row:
+        return row[0]
+    try:
+        img_text = normalize_text(pytesseract.image_to_string(Image.open(screenshot_path), lang='ukr+rus'))
+    except:
+        return ""
+    c.execute("INSERT OR REPLACE INTO ocr_cache (screenshot_path, text) VALUES (?, ?)", (screenshot_path, img_text))
+    conn.commit()
+    return img_text
+
+# Префіксний індекс термінів для підказок запитів
+class PrefixIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.terms = []  # відсортований масив термінів
+        self.top_by_letter = {}  # кеш найчастіших термінів для однолітерних префіксів
+
+    def add_text(self, text):
+        with self.lock:
+            for term in normalize_text(text).split():
+                if term not in self.counts:
+                    bisect.insort(self.terms, term)
+                    self.counts[term] = 0
+                self.counts[term] += 1
+                self.top_by_letter.pop(term[0], None)
+
+    def remove_text(self, text):
+        with self.lock:
+            for term in normalize_text(text).split():
+                if term not in self.counts:
+                    continue
+                self.counts[term] -= 1
+                self.top_by_letter.pop(term[0], None)
+                if self.counts[term] <= 0:
+                    del self.counts[term]
+                    del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def suggest(self, prefix, limit=5):
+        with self.lock:
+            # Однолітерний префікс охоплює найбільший діапазон - результат кешується до зміни термінів на цю літеру
+            if len(prefix) == 1 and len(self.top_by_letter.get(prefix, ())) >= limit:
+                return self.top_by_letter[prefix][:limit]
+            start = bisect.bisect_left(self.terms, prefix)
+            end = bisect.bisect_left(self.terms, prefix + '\uffff', start)
+            # Ранжування за частотою по всьому діапазону префікса (без копіювання зрізу)
+            best = heapq.nlargest(limit, (self.terms[i] for i in range(start, end)), key=self.counts.get)
+            result = [(term, self.counts[term]) for term in best]
+            if len(prefix) == 1:
+                self.top_by_letter[prefix] = result
+            return result
+
+# Функція отримання тексту запису для індексу (опис + кешований OCR)
+def get_record_index_text(conn, db_name, record_id):
+    c = conn.cursor()
+    c.execute(f'''SELECT {db_name}.description, ocr_cache.text FROM {db_name}
+                LEFT JOIN ocr_cache ON ocr_cache.screenshot_path = {db_name}.screenshot_path
+                WHERE {db_name}.id = ?''', (record_id,))
+    row = c.fetchone()
+    if not row:
+        return ""
+    return f"{row[0] or ''} {row[1] or ''}"
+
+# Функція підказок для запиту (доповнення останнього слова)
+def get_query_suggestions(query, limit=5):
+    words = normalize_text(query).split()
+    if not words or query.endswith(" "):
+        return []
+    counts = {}
+    for db_name in ['news', 'instructions']:
+        for term, count in get_prefix_index(db_name).suggest(words[-1], limit + 1):
+            counts[term] = counts.get(term, 0) + count
+    counts.pop(words[-1], None)
+    best = heapq.nlargest(limit, counts, key=counts.get)
+    return [" ".join(words[:-1] + [term]) for term in best]
+
+# Функція вибору підказки
+def apply_suggestion(suggestion):
+    st.session_state.search_query = suggestion
+
+# Функція розбиття тексту на пасажі з перекриттям
+def chunk_text(text, size=PASSAGE_WORDS, overlap=PASSAGE_OVERLAP):
+    words = text.split()
+    step = size - overlap
+    return [" ".join(words[i:i + size]) for i in range(0, max(len(words) - overlap, 1), step) if words[i:i + size]]
+
+# Функція обчислення ембедингів пасажів запису (опис + фрагменти OCR)
+def encode_passages(description, img_text):
+    passages = [description or ""] + chunk_text(img_text or "")
+    return passages, model.encode(passages, normalize_embeddings=True).astype(np.float32)
+
+# Функція збереження пасажів запису (без commit - у транзакції виклику)
+def store_record_passages(conn, record_id, passages, embeddings):
+    c = conn.cursor()
+    c.execute("DELETE FROM passages WHERE record_id = ?", (record_id,))
+    c.executemany("INSERT INTO passages (record_id, position, text, embedding) VALUES (?, ?, ?, ?)",
+                  [(record_id, i, passage, embedding.tobytes()) for i, (passage, embedding) in enumerate(zip(passages, embeddings))])
+
+# Функція читання ембедингів пасажів запису
+def load_record_passages(conn, record_id):
+    c = conn.cursor()
+    c.execute("SELECT embedding FROM passages WHERE record_id = ? ORDER BY position", (record_id,))
+    return np.array([np.frombuffer(row[0], dtype=np.float32) for row in c.fetchall()], dtype=np.float32)
+
+# Функція пошуку найкращого фрагмента тексту скріншота для запиту
+def get_best_passage(conn, record_id, query_embedding):
+    c = conn.cursor()
+    c.execute("SELECT position, text, embedding FROM passages WHERE record_id = ?", (record_id,))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    position, text, embedding = max(rows, key=lambda row: float(np.frombuffer(row[2], dtype=np.float32) @ query_embedding))
+    # Позиція 0 - опис, який і так показується в записі
+    return text if position > 0 else None
+
+# Індекс пасажів у пам'яті (ембединги пов'язані з батьківським записом).
+# Базова частина (зі знімка - відображена з диска) при змінах не копіюється:
+# видалені пасажі позначаються маскою, нові додаються в окремий масив
+class PassageIndex:
+    def __init__(self, dim):
+        self.lock = threading.Lock()
+        self.base_ids = np.empty(0, dtype=np.int64)
+        self.base_vectors = np.empty((0, dim), dtype=np.float32)
+        self.base_keep = np.empty(0, dtype=bool)
+        self.added_ids = np.empty(0, dtype=np.int64)
+        self.added_vectors = np.empty((0, dim), dtype=np.float32)
+
+    def load(self, record_ids, vectors):
+        with self.lock:
+            self.base_ids = record_ids
+            self.base_vectors = vectors
+            self.base_keep = np.ones(len(record_ids), dtype=bool)
+            self.added_ids = self.added_ids[:0]
+            self.added_vectors = self.added_vectors[:0]
+
+    def add(self, record_id, vectors):
+        if not len(vectors):
+            return
+        with self.lock:
+            self.added_ids = np.concatenate([self.added_ids, np.full(len(vectors), record_id, dtype=np.int64)])
+            self.added_vectors = np.vstack([self.added_vectors, vectors])
+
+    def remove(self, record_id):
+        with self.lock:
+            self.base_keep = self.base_keep & (self.base_ids != record_id)
+            keep = self.added_ids != record_id
+            self.added_ids = self.added_ids[keep]
+            self.added_vectors = self.added_vectors[keep]
+
+    def parts(self):
+        # Масиви лише замінюються, а не змінюються на місці, тому посилань достатньо
+        with self.lock:
+            return self.base_ids, self.base_vectors, self.base_keep, self.added_ids, self.added_vectors
+
+    @staticmethod
+    def merge_parts(parts):
+        base_ids, base_vectors, base_keep, added_ids, added_vectors = parts
+        return (np.concatenate([base_ids[base_keep], added_ids]),
+                np.vstack([base_vectors[base_keep], added_vectors]))
+
+    def score(self, query_vector, pooling=PASSAGE_POOLING):
+        base_ids, base_vectors, base_keep, added_ids, added_vectors = self.parts()
+        record_ids = np.concatenate([base_ids[base_keep], added_ids])
+        if not len(record_ids):
+            return record_ids, np.empty(0, dtype=np.float32)
+        similarities = np.concatenate([(base_vectors @ query_vector)[base_keep], added_vectors @ query_vector])
+        doc_ids, inverse = np.unique(record_ids, return_inverse=True)
+        if pooling == "mean":
+            scores = np.bincount(inverse, weights=similarities) / np.bincount(inverse)
+        else:
+            scores = np.full(len(doc_ids), -np.inf)
+            np.maximum.at(scores, inverse, similarities)
+        return doc_ids, scores
+
+    def __len__(self):
+        return int(self.base_keep.sum()) + len(self.added_ids)
+
+    def index_size(self):
+        # Розмір індексу в байтах; для векторів зі знімка (mmap) це розмір відображеного файлу, а не RSS
+        return (self.base_ids.nbytes + self.base_vectors.nbytes + self.base_keep.nbytes
+                + self.added_ids.nbytes + self.added_vectors.nbytes)
+
+    def is_mapped(self):
+        return isinstance(self.base_vectors, np.memmap)
+
+# Стан пошуку бази: тексти записів, префіксний індекс та індекс пасажів.
+# Змінюється лише під holder["lock"] (див. get_search_state_holder)
+class SearchState:
+    def __init__(self, generation, dim):
+        self.generation = generation
+        self.texts = {}
+        self.prefix_index = PrefixIndex()
+        self.passage_index = PassageIndex(dim) if dim else None
+
+    def add_record(self, record_id, text, vectors=None):
+        text = normalize_text(text)
+        self.texts[record_id] = text
+        self.prefix_index.add_text(text)
+        if self.passage_index is not None and vectors is not None:
+            self.passage_index.add(record_id, vectors)
+
+    def remove_record(self, record_id):
+        self.prefix_index.remove_text(self.texts.pop(record_id, ""))
+        if self.passage_index is not None:
+            self.passage_index.remove(record_id)
+
+# Функція отримання покоління корпусу
+def get_generation(conn):
+    c = conn.cursor()
+    c.execute("SELECT value FROM search_meta WHERE key = 'generation'")
+    row = c.fetchone()
+    return int(row[0]) if row else 0
+
+# Функція збільшення покоління корпусу (у тій самій транзакції, що й зміна)
+def bump_generation(conn):
+    c = conn.cursor()
+    c.execute("""INSERT INTO search_meta (key, value) VALUES ('generation', 1)
+                ON CONFLICT(key) DO UPDATE SET value = value + 1""")
+    return get_generation(conn)
+
+# Функція контрольної суми корпусу
+def corpus_checksum(conn, db_name):
+    c = conn.cursor()
+    c.execute(f"SELECT id, description, screenshot_path FROM {db_name} ORDER BY id")
+    digest = hashlib.sha256()
+    for row in c:
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+# Функція фіксації зміни корпусу: покоління збільшується в тій самій транзакції
+def commit_corpus_change(conn):
+    generation = bump_generation(conn)
+    conn.commit()
+    return generation
+
+# Функція читання версії корпусу (покоління та контрольна сума з одного знімка бази)
+def read_corpus_version(conn, db_name):
+    conn.execute("BEGIN")
+    try:
+        return get_generation(conn), corpus_checksum(conn, db_name)
+    finally:
+        conn.commit()
+
+# Функція побудови стану пошуку з бази.
+# Лише дані, що вже є в базі: кешований OCR та збережені пасажі, без Tesseract і моделі
+def build_search_state(conn, db_name):
+    dim = model.get_sentence_embedding_dimension() if model else 0
+    c = conn.cursor()
+    conn.execute("BEGIN")
+    try:
+        state = SearchState(get_generation(conn), dim)
+        c.execute(f'''SELECT {db_name}.id, {db_name}.description, ocr_cache.text FROM {db_name}
+                    LEFT JOIN ocr_cache ON ocr_cache.screenshot_path = {db_name}.screenshot_path''')
+        for record_id, description, img_text in c.fetchall():
+            state.add_record(record_id, f"{description or ''} {img_text or ''}")
+        
+        if dim:
+            c.execute(f"""SELECT record_id, embedding FROM passages
+                        WHERE record_id IN (SELECT id FROM {db_name}) ORDER BY record_id, position""")
+            rows = c.fetchall()
+            if rows:
+                state.passage_index.load(np.array([row[0] for row in rows], dtype=np.int64),
+                                         np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows]))
+    finally:
+        conn.commit()
+    return state
+
+# Функція шляху до знімка стану пошуку
+def snapshot_dir(db_name):
+    return os.path.join(DB_DIR, f"snapshot_{db_name}")
+
+# Функція запису файлів знімка стану пошуку на диск
+def write_search_snapshot(db_name, generation, checksum, texts, terms, vectors_parts):
+    directory = snapshot_dir(db_name)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, "meta.json")
+    
+    name = f"g{generation}_{uuid.uuid4().hex}"
+    files = {"texts": f"{name}_texts.json"}
+    with open(os.path.join(directory, files["texts"]), "w", encoding="utf-8") as f:
+        json.dump({"texts": texts, "terms": terms}, f, ensure_ascii=False)
+    
+    dim = 0
+    if vectors_parts is not None:
+        record_ids, vectors = PassageIndex.merge_parts(vectors_parts)
+        dim = vectors.shape[1]
+        files["ids"] = f"{name}_ids.npy"
+        files["vectors"] = f"{name}_vectors.npy"
+        with open(os.path.join(directory, files["ids"]), "wb") as f:
+            np.save(f, record_ids)
+        with open(os.path.join(directory, files["vectors"]), "wb") as f:
+            np.save(f, vectors)
+    
+    old_files = []
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                old_files = list(json.load(f)["files"].values())
+        except Exception:
+            pass
+    
+    # meta.json замінюється атомарно, тому воркери бачать лише повний знімок
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "generation": generation, "checksum": checksum,
+                       "dim": dim, "files": files}, f)
+        os.replace(tmp_path, meta_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    for old_file in old_files:
+        if old_file not in files.values():
+            try:
+                os.remove(os.path.join(directory, old_file))
+            except OSError:
+                # Файл міг бути видалений іншим воркером або ще відображений у пам'ять (Windows)
+                pass
+
+# Функція збереження знімка стану пошуку (у фоновому потоці, див. schedule_snapshot_save)
+def save_search_snapshot(db_name):
+    holder = get_search_state_holder(db_name)
+    try:
+        with holder["save_lock"]:
+            # Під holder["lock"] лише копіюється стан; контрольна сума та запис на диск - без нього
+            with holder["lock"]:
+                holder["save_timer"] = None
+                state = holder["state"]
+                if state is None:
+                    return
+                generation = state.generation
+                texts = {str(record_id): text for record_id, text in state.texts.items()}
+                with state.prefix_index.lock:
+                    terms = [[term, state.prefix_index.counts[term]] for term in state.prefix_index.terms]
+                vectors_parts = state.passage_index.parts() if state.passage_index is not None else None
+            
+            conn = sqlite3.connect(os.path.join(DB_DIR, f'{db_name}.db'))
+            try:
+                db_generation, checksum = read_corpus_version(conn, db_name)
+            finally:
+                conn.close()
+            # Стан застарів (базу вже змінено) - актуальний стан збереже наступний виклик
+            if db_generation != generation:
+                return
+            write_search_snapshot(db_name, generation, checksum, texts, terms, vectors_parts)
+    except Exception as e:
+        logger.warning(f"Не вдалося зберегти знімок стану пошуку {db_name}: {e}")
+
+# Функція відкладеного збереження знімка: кілька змін поспіль - один запис на диск
+def schedule_snapshot_save(db_name):
+    holder = get_search_state_holder(db_name)
+    with holder["lock"]:
+        if holder["save_timer"] is not None:
+            return
+        timer = threading.Timer(SNAPSHOT_SAVE_DELAY, save_search_snapshot, args=(db_name,))
+        timer.daemon = True
+        holder["save_timer"] = timer
+    timer.start()
+
+# Функція завантаження знімка стану пошуку (None, якщо знімок застарів)
+def load_search_snapshot(db_name, generation, checksum):
+    directory = snapshot_dir(db_name)
+    try:
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        dim = model.get_sentence_embedding_dimension() if model else 0
+        if (meta["version"] != SNAPSHOT_VERSION or meta["generation"] != generation
+                or meta["checksum"] != checksum or meta["dim"] != dim):
+            return None
+        
+        with open(os.path.join(directory, meta["files"]["texts"]), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        state = SearchState(generation, dim)
+        state.texts = {int(record_id): text for record_id, text in data["texts"].items()}
+        state.prefix_index.terms = [term for term, _ in data["terms"]]
+        state.prefix_index.counts = dict(data["terms"])
+        if dim:
+            # Вектори відображаються у пам'ять і спільні між воркерами через кеш сторінок ОС
+            state.passage_index.load(np.load(os.path.join(directory, meta["files"]["ids"])),
+                                     np.load(os.path.join(directory, meta["files"]["vectors"]), mmap_mode="r"))
+        return state
+    except Exception:
+        return None
+
+# Сховище стану пошуку бази (спільне для всіх сесій)
+@st.cache_resource
+def get_search_state_holder(db_name):
+    return {"lock": threading.Lock(), "state": None, "save_lock": threading.Lock(), "save_timer": None}
+
+# Функція отримання стану пошуку (зі знімка або з бази).
+# refresh=False повертає вже завантажений стан без перевірки покоління (для підказок)
+def get_search_state(db_name, refresh=True):
+    holder = get_search_state_holder(db_name)
+    state = holder["state"]
+    if state is not None and not refresh:
+        return state
+    
+    conn = sqlite3.connect(os.path.join(DB_DIR, f'{db_name}.db'))
+    try:
+        if state is not None and state.generation == get_generation(conn):
+            return state
+        rebuilt = False
+        with holder["lock"]:
+            generation, checksum = read_corpus_version(conn, db_name)
+            state = holder["state"]
+            if state is None or state.generation != generation:
+                state = load_search_snapshot(db_name, generation, checksum)
+                if state is None:
+                    state = build_search_state(conn, db_name)
+                    rebuilt = True
+                holder["state"] = state
+        if rebuilt:
+            schedule_snapshot_save(db_name)
+        return state
+    finally:
+        conn.close()
+
+# Функція застосування інкрементної зміни до стану пошуку (знімок зберігається у фоні).
+# Запис у базі вже зафіксовано, тому помилки тут не повертаються виклику:
+# стан скидається і буде перебудований при наступному пошуку
+def apply_search_change(db_name, generation, change):
+    holder = get_search_state_holder(db_name)
+    try:
+        with holder["lock"]:
+            state = holder["state"]
+            # Якщо між змінами базу змінив інший воркер, стан буде перезавантажено при наступному пошуку
+            if state is None or generation != state.generation + 1:
+                return
+            change(state)
+            state.generation = generation
+        schedule_snapshot_save(db_name)
+    except Exception as e:
+        with holder["lock"]:
+            holder["state"] = None
+        logger.warning(f"Не вдалося оновити стан пошуку {db_name}, його буде перебудовано: {e}")
+
+# Функція дообчислення OCR та пасажів (лише у шляху пошуку): для записів без пасажів
+# і для записів, OCR скріншота яких ще не вдався (повторюється, доки не вдасться)
+def backfill_passages(conn, db_name):
+    c = conn.cursor()
+    c.execute(f"""SELECT id, description, screenshot_path, id IN (SELECT record_id FROM passages) FROM {db_name}
+                WHERE id NOT IN (SELECT record_id FROM passages)
+                OR (screenshot_path != '' AND screenshot_path NOT IN (SELECT screenshot_path FROM ocr_cache))""")
+    rows = c.fetchall()
+    if not rows:
+        return
+    
+    computed = []
+    for record_id, description, screenshot_path, has_passages in rows:
+        img_text = get_ocr_text(conn, screenshot_path)
+        if has_passages and not img_text:
+            # OCR знову не вдався - пасажі опису лишаються, спроба буде при наступному пошуку
+            continue
+        passages, embeddings = encode_passages(description, img_text)
+        computed.append((record_id, f"{description or ''} {img_text}", passages, embeddings))
+    if not computed:
+        return
+    for record_id, _, passages, embeddings in computed:
+        store_record_passages(conn, record_id, passages, embeddings)
+    generation = commit_corpus_change(conn)
+    
+    def change(state):
+        for record_id, text, _, embeddings in computed:
+            state.remove_record(record_id)
+            state.add_record(record_id, text, embeddings)
+    apply_search_change(db_name, generation, change)
+
+# Функція отримання префіксного індексу бази (без перевірки покоління - шлях підказок)
+def get_prefix_index(db_name):
+    return get_search_state(db_name, refresh=False).prefix_index
+
+# Функція отримання індексу пасажів бази
+def get_passage_index(db_name, refresh=True):
+    return get_search_state(db_name, refresh).passage_index
+
 # Функція додавання до бази
 def add_to_db(db_name, description, screenshot, original_link, additional_links=None):
     try:
@@ -107,10 +629,19 @@ def add_to_db(db_name, description, screenshot, original_link, additional_links=
             with open(screenshot_path, "wb") as f:
                 f.write(screenshot.getbuffer())
         
+        # OCR та ембединги обчислюються один раз при додаванні, до транзакції
+        img_text = get_ocr_text(conn, screenshot_path)
+        passages, embeddings = encode_passages(description, img_text) if model else (None, None)
+        
         c.execute(f"INSERT INTO {db_name} (description, screenshot_path, original_link, additional_links) VALUES (?, ?, ?, ?)",
                 (description, screenshot_path, original_link, additional_links))
+        record_id = c.lastrowid
+        if model:
+            store_record_passages(conn, record_id, passages, embeddings)
+        generation = commit_corpus_change(conn)
         
-        conn.commit()
+        apply_search_change(db_name, generation,
+                            lambda state: state.add_record(record_id, f"{description} {img_text}", embeddings))
         return True
     except Exception as e:
         st.error(f"Помилка збереження в базу: {str(e)}")
@@ -120,33 +651,25 @@ def add_to_db(db_name, description, screenshot, original_link, additional_links=
             conn.close()
 
 # Функція пошуку в базі
-def search_in_db(query, db_name, num_results=5):
+def search_in_db(query, db_name, num_results=5, pooling=PASSAGE_POOLING):
     try:
         conn = sqlite3.connect(os.path.join(DB_DIR, f'{db_name}.db'))
         c = conn.cursor()
         
         c.execute(f"SELECT * FROM {db_name}")
-        records = c.fetchall()
+        records = {record[0]: record for record in c.fetchall()}
         
         if not records or not model:
             return []
         
-        texts = []
-        for record in records:
-            text = record[1]
-            if record[2]:
-                try:
-                    img_text = pytesseract.image_to_string(Image.open(record[2]), lang='ukr+rus')
-                    text += " " + normalize_text(img_text)
-                except:
-                    pass
-            texts.append(text)
+        backfill_passages(conn, db_name)
         
-        query_embedding = model.encode([normalize_text(query)])[0]
-        doc_embeddings = model.encode(texts)
-        similarities = cosine_similarity([query_embedding], doc_embeddings)[0]
-        sorted_indices = np.argsort(similarities)[::-1]
-        return [(records[i], similarities[i]) for i in sorted_indices[:num_results]]
+        # Оцінка документа - пулінг схожостей його пасажів
+        query_embedding = model.encode([normalize_text(query)], normalize_embeddings=True)[0].astype(np.float32)
+        doc_ids, scores = get_passage_index(db_name).score(query_embedding, pooling)
+        sorted_indices = np.argsort(scores)[::-1]
+        top = [(records[int(doc_ids[i])], scores[i]) for i in sorted_indices if int(doc_ids[i]) in records][:num_results]
+        return [(record, score, get_best_passage(conn, record[0], query_embedding)) for record, score in top]
     except Exception as e:
         st.error(f"Помилка пошуку: {str(e)}")
         return []
@@ -161,7 +684,8 @@ def delete_record(record_id, db_name):
         c = conn.cursor()
         c.execute(f"INSERT INTO deleted_{db_name} SELECT *, CURRENT_TIMESTAMP FROM {db_name} WHERE id = ?", (record_id,))
         c.execute(f"DELETE FROM {db_name} WHERE id = ?", (record_id,))
-        conn.commit()
+        generation = commit_corpus_change(conn)
+        apply_search_change(db_name, generation, lambda state: state.remove_record(record_id))
         return True
     except Exception as e:
         st.error(f"Помилка видалення: {str(e)}")
@@ -177,7 +701,11 @@ def restore_record(record_id, db_name):
         c = conn.cursor()
         c.execute(f"INSERT INTO {db_name} SELECT id, description, screenshot_path, original_link, additional_links, timestamp FROM deleted_{db_name} WHERE id = ?", (record_id,))
         c.execute(f"DELETE FROM deleted_{db_name} WHERE id = ?", (record_id,))
-        conn.commit()
+        # Пасажі зберігаються після видалення; записи без них дообчислюються при пошуку
+        text = get_record_index_text(conn, db_name, record_id)
+        vectors = load_record_passages(conn, record_id) if model else None
+        generation = commit_corpus_change(conn)
+        apply_search_change(db_name, generation, lambda state: state.add_record(record_id, text, vectors))
         return True
     except Exception as e:
         st.error(f"Помилка відновлення: {str(e)}")
@@ -186,6 +714,119 @@ def restore_record(record_id, db_name):
         if conn:
             conn.close()
 
+# Функція узгодженої копії бази через SQLite online backup API
+def snapshot_db(db_name, dest_path):
+    src = sqlite3.connect(os.path.join(DB_DIR, f'{db_name}.db'))
+    dst = sqlite3.connect(dest_path)
+    try:
+        with dst:
+            src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+# Функція читання маніфесту останньої резервної копії
+def load_backup_manifest():
+    if not os.path.exists(BACKUP_MANIFEST):
+        return {"created": None, "uploads": []}
+    with open(BACKUP_MANIFEST, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# Функція атомарного запису маніфесту резервної копії
+def save_backup_manifest(manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=BACKUP_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, BACKUP_MANIFEST)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Функція додавання файлу до архіву (файл міг зникнути під час копіювання)
+def add_to_archive(tar, path, arcname):
+    try:
+        tar.add(path, arcname=arcname)
+        return True
+    except FileNotFoundError:
+        return False
+
+# Функція додавання індексних файлів з DB_DIR до архіву
+def add_index_files(tar):
+    for entry in sorted(os.listdir(DB_DIR)):
+        path = os.path.join(DB_DIR, entry)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.isdir(path):
+            # Знімок стану пошуку: лише файли з його meta.json, сам meta.json - останнім
+            try:
+                with open(meta_path, "rb") as f:
+                    meta_data = f.read()
+                files = json.loads(meta_data)["files"].values()
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+            if all(add_to_archive(tar, os.path.join(path, name), f"{DB_DIR}/{entry}/{name}") for name in files):
+                info = tarfile.TarInfo(f"{DB_DIR}/{entry}/meta.json")
+                info.size = len(meta_data)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(meta_data))
+        elif not entry.endswith((".db", "-journal", "-wal", "-shm")):
+            add_to_archive(tar, path, f"{DB_DIR}/{entry}")
+
+# Функція видалення старих архівів понад BACKUP_KEEP
+def prune_backup_archives(keep=BACKUP_KEEP):
+    archives = sorted((entry for entry in os.listdir(BACKUP_DIR) if entry.endswith(".tar.gz")),
+                      key=lambda entry: os.path.getmtime(os.path.join(BACKUP_DIR, entry)))
+    for entry in archives[:-keep] if keep else archives:
+        os.remove(os.path.join(BACKUP_DIR, entry))
+
+# Функція створення стисненого архіву резервної копії
+def create_backup_archive(incremental=False):
+    manifest = load_backup_manifest()
+    known_uploads = set(manifest["uploads"]) if incremental else set()
+
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    stamp = f"{timestamp}_{uuid.uuid4().hex[:8]}"
+    kind = "incremental" if incremental and manifest["created"] else "full"
+    archive_path = os.path.join(BACKUP_DIR, f"backup_{kind}_{stamp}.tar.gz")
+    tmp_path = archive_path + ".tmp"
+
+    snapshots = []
+    try:
+        with tarfile.open(tmp_path, "w:gz") as tar:
+            # Бази даних (узгоджений знімок, навіть під час запису)
+            for db_name in ['news', 'instructions']:
+                snapshot_path = os.path.join(BACKUP_DIR, f"{db_name}_{stamp}.db")
+                snapshot_db(db_name, snapshot_path)
+                snapshots.append(snapshot_path)
+                tar.add(snapshot_path, arcname=f"{DB_DIR}/{db_name}.db")
+
+            # Індексні файли поруч з базами
+            add_index_files(tar)
+
+            # Скріншоти (для інкрементної копії - лише нові)
+            uploads = sorted(os.listdir(UPLOAD_DIR))
+            for entry in uploads:
+                if entry not in known_uploads:
+                    add_to_archive(tar, os.path.join(UPLOAD_DIR, entry), f"{UPLOAD_DIR}/{entry}")
+        os.replace(tmp_path, archive_path)
+    finally:
+        for snapshot_path in snapshots:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    prune_backup_archives()
+
+    # Маніфест оновлюється лише після завантаження архіву (див. finish_backup_download)
+    return archive_path, {"created": timestamp, "uploads": sorted(known_uploads | set(uploads))}
+
+# Функція завершення завантаження архіву: фіксація маніфесту та видалення архіву
+def finish_backup_download(archive_path, manifest):
+    save_backup_manifest(manifest)
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+
 # Головний додаток
 def main():
     st.set_page_config(layout="wide", page_title="Інтелектуальний пошук новин та інструкцій")
@@ -533,6 +1174,16 @@ def main():
     st.markdown("---")
     search_query = st.text_input("🔍 Введіть запит для пошуку:", key="search_query", placeholder="Пошук новин та інструкцій...")
     
+    # Підказки з префіксного індексу (без семантичного пошуку).
+    # st.text_input у Streamlit 1.22 перезапускає сторінку лише після Enter або втрати фокусу,
+    # тому підказки оновлюються після введення запиту, а не на кожну натиснуту клавішу
+    suggestions = get_query_suggestions(search_query)
+    if suggestions:
+        suggestion_cols = st.columns(len(suggestions))
+        for i, suggestion in enumerate(suggestions):
+            with suggestion_cols[i]:
+                st.button(f"🔎 {suggestion}", key=f"suggestion_{i}", on_click=apply_suggestion, args=(suggestion,))
+    
     col_search, col_num = st.columns([3, 1])
     with col_search:
         search_btn = st.button("🚀 ПОШУК", key="search_btn", use_container_width=True)
@@ -551,8 +1202,8 @@ def main():
         
         if results:
             st.subheader("Основні результати")
-            for (record, score) in results:
-                display_record(record, score, db_name, show_delete=st.session_state.is_admin)
+            for (record, score, passage) in results:
+                display_record(record, score, db_name, show_delete=st.session_state.is_admin, passage=passage)
             
             # Пошук в іншій базі
             other_db = "instructions" if db_name == "news" else "news"
@@ -560,8 +1211,8 @@ def main():
             
             if other_results:
                 st.subheader("Інші результати")
-                for (record, score) in other_results:
-                    display_record(record, score, other_db, show_delete=st.session_state.is_admin)
+                for (record, score, passage) in other_results:
+                    display_record(record, score, other_db, show_delete=st.session_state.is_admin, passage=passage)
         else:
             st.warning("Нічого не знайдено. Спробуйте інший запит.")
     
@@ -645,24 +1296,37 @@ def main():
         st.subheader("🔄 Резервне копіювання")
         
         with st.expander("📥 Завантажити бази даних"):
-            try:
-                with open(os.path.join(DB_DIR, "news.db"), "rb") as f_news:
-                    st.download_button(
-                        label="Завантажити базу новин",
-                        data=f_news,
-                        file_name="news_backup.db",
-                        mime="application/octet-stream"
-                    )
-                
-                with open(os.path.join(DB_DIR, "instructions.db"), "rb") as f_instr:
-                    st.download_button(
-                        label="Завантажити базу інструкцій",
-                        data=f_instr,
-                        file_name="instructions_backup.db",
-                        mime="application/octet-stream"
-                    )
-            except Exception as e:
-                st.error(f"Помилка резервного копіювання: {str(e)}")
+            backup_mode = st.radio("Тип копії:", ["Повна", "Інкрементна"], horizontal=True, key="backup_mode")
+            manifest = load_backup_manifest()
+            if manifest["created"]:
+                st.caption(f"Остання копія: {manifest['created']}")
+            
+            # Архів будується лише на вимогу, а не при кожному перезапуску сторінки
+            if st.button("📦 Створити архів", key="create_backup_btn"):
+                try:
+                    archive_path, new_manifest = create_backup_archive(incremental=(backup_mode == "Інкрементна"))
+                    # Кнопка завантаження показується лише один раз після побудови архіву,
+                    # щоб архів не зчитувався в пам'ять при кожному перезапуску сторінки
+                    with open(archive_path, "rb") as f_archive:
+                        st.download_button(
+                            label="Завантажити архів",
+                            data=f_archive,
+                            file_name=os.path.basename(archive_path),
+                            mime="application/gzip",
+                            on_click=finish_backup_download,
+                            args=(archive_path, new_manifest)
+                        )
+                    st.caption("Кнопка зникне після наступної дії на сторінці.")
+                except Exception as e:
+                    st.error(f"Помилка резервного копіювання: {str(e)}")
+        
+        if model:
+            with st.expander("📊 Індекс пасажів"):
+                for db_name, label in [("news", "Новини"), ("instructions", "Інструкції")]:
+                    passage_index = get_passage_index(db_name, refresh=False)
+                    source = "відображено з диска" if passage_index.is_mapped() else "у пам'яті"
+                    st.markdown(f"**{label}:** {len(passage_index)} пасажів, "
+                              f"розмір індексу {passage_index.index_size() / 1024:.1f} КБ ({source})")
         
         st.markdown("---")
         if st.button("🚪 Вийти з системи"):
@@ -670,7 +1334,7 @@ def main():
             st.experimental_rerun()
 
 # Функція відображення запису
-def display_record(record, score, db_name, show_delete=False, show_restore=False):
+def display_record(record, score, db_name, show_delete=False, show_restore=False, passage=None):
     try:
         id, desc, screenshot_path, orig_link, add_links, timestamp = record[:6]
         
@@ -694,6 +1358,10 @@ def display_record(record, score, db_name, show_delete=False, show_restore=False
             # Опис
             st.markdown(f"**Опис:** {desc}")
             
+            # Найкращий фрагмент тексту зі скріншота
+            if passage:
+                st.markdown(f"**Збіг у тексті скріншота:** …{passage}…")
+            
             # Скріншоти
             if screenshot_path and os.path.exists(screenshot_path):
                 st.markdown("**Скріншот:**")